@@ -1,14 +1,20 @@
 # find_coords.py
-import math
+import numpy as np
 
-def tile_to_lat_lon(z, x, y):
-    """Converts TMS tile coordinates to latitude and longitude."""
+def tiles_to_lat_lon(z, x, y):
+    """Converts arrays of TMS tile coordinates to latitude and longitude arrays."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
     n = 2.0 ** z
     lon_deg = x / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y / n)))
-    lat_deg = math.degrees(lat_rad)
+    # Inverse Gudermannian: 2*atan(exp(t)) - pi/2 == atan(sinh(t)), one fewer transcendental
+    lat_deg = np.degrees(2 * np.arctan(np.exp(np.pi * (1 - 2 * y / n))) - np.pi / 2)
     return (lat_deg, lon_deg)
 
+def tile_to_lat_lon(z, x, y):
+    """Converts TMS tile coordinates to latitude and longitude."""
+    return tuple(float(v) for v in tiles_to_lat_lon(z, x, y))
+
 # --- IMPORTANT ---
 # Use the tile coordinates that YOU ACTUALLY HAVE from your 'tree' command.
 # In your case, these are:
@@ -0,0 +1,109 @@
+# =============================================================================
+# Mars Mapper JP2 Batch Worker
+# =============================================================================
+# Long-lived converter started by process_data.py, one per Step 1 worker.
+# GDAL (driver registry, PROJ database) is initialized once per worker and
+# reused for every file, instead of once per file with gdal_translate.exe.
+#
+# Protocol (UTF-8, one line per file):
+#   stdin:  <input JP2 path>\t<output GeoTIFF path>
+#   stdout: OK\t<output GeoTIFF path>   or   ERR\t<message>
+# Output is written to <output>.part and renamed into place only once complete, so an
+# interrupted conversion never leaves a truncated .tif that looks up to date.
+# Replies go out on a duplicate of the original stdout; fd 1 itself is pointed at stderr so
+# anything a C library or driver prints can't get interleaved with the protocol.
+# Command-line arguments are GTiff creation options (e.g. TILED=YES).
+
+import os
+import sys
+import shutil
+import subprocess
+from pathlib import Path
+
+os.environ['PROJ_IGNORE_CELESTIAL_BODY'] = 'YES'
+
+from osgeo import gdal
+
+# No gdal.UseExceptions(): HiRISE JP2 metadata can carry non-UTF-8 text, and turning GDAL
+# messages into Python exceptions is exactly where the bindings hit UnicodeDecodeError.
+# Errors are kept quiet and checked through the return value instead.
+gdal.PushErrorHandler('CPLQuietErrorHandler')
+
+
+def _find_gdal_translate():
+    """Locate the gdal_translate executable belonging to this Python's GDAL install."""
+    found = shutil.which("gdal_translate")
+    if found:
+        return found
+    env_root = Path(sys.executable).parent
+    for candidate in (env_root / "Library" / "bin" / "gdal_translate.exe",  # conda on Windows
+                      env_root / "gdal_translate"):
+        if candidate.exists():
+            return str(candidate)
+    return "gdal_translate"
+
+
+def _last_error_message():
+    try:
+        return gdal.GetLastErrorMsg() or "gdal.Translate failed"
+    except UnicodeDecodeError:
+        return "gdal.Translate failed (error message is not valid UTF-8)"
+
+
+def _translate_in_process(jp2_path, part_tif, translate_options):
+    """Convert with the Python bindings. Returns None on success, else an error message."""
+    gdal.ErrorReset()
+    ds = gdal.Translate(part_tif, jp2_path, options=translate_options)
+    if ds is None:
+        return _last_error_message()
+    ds = None  # Flush and close before publishing the file
+    return None
+
+
+def _translate_with_cli(jp2_path, part_tif, creation_options):
+    """Convert one file with gdal_translate, as the original pipeline did for every file."""
+    cmd = [_find_gdal_translate(), "-q", "-of", "GTiff"]
+    for option in creation_options:
+        cmd += ["-co", option]
+    cmd += [jp2_path, part_tif]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        stderr = result.stderr.decode(errors='replace').strip()
+        return stderr or f"gdal_translate exited with code {result.returncode}"
+    return None
+
+
+def main():
+    sys.stdin.reconfigure(encoding='utf-8', errors='replace')
+    reply = open(os.dup(1), 'w', encoding='utf-8', errors='replace', buffering=1)
+    os.dup2(2, 1)
+    creation_options = sys.argv[1:]
+    translate_options = gdal.TranslateOptions(format='GTiff', creationOptions=creation_options)
+
+    for line in sys.stdin:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        part_tif = None
+        try:
+            jp2_path, output_tif = line.split('\t')
+            part_tif = f"{output_tif}.part"
+            try:
+                error = _translate_in_process(jp2_path, part_tif, translate_options)
+            except UnicodeDecodeError:
+                # The bindings still tripped over this file's metadata; redo it out of process.
+                error = _translate_with_cli(jp2_path, part_tif, creation_options)
+            if error is None:
+                os.replace(part_tif, output_tif)
+                print(f"OK\t{output_tif}", file=reply)
+                continue
+        except Exception as e:
+            error = str(e)
+        if part_tif and os.path.exists(part_tif):
+            os.remove(part_tif)
+        message = error.replace('\n', ' ')
+        print(f"ERR\t{message}", file=reply)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,17 @@
 # =============================================================================
 
 import os
+import sys
+import json
+import argparse
 import shutil
 import time
+import threading
 import subprocess
+import multiprocessing
+import multiprocessing.util
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
 from pathlib import Path
 from osgeo import gdal
 from osgeo_utils import gdal2tiles
@@ -13,9 +21,6 @@ from osgeo_utils import gdal2tiles
 # ----------------- GDAL Environment -----------------
 os.environ['PROJ_IGNORE_CELESTIAL_BODY'] = 'YES'
 
-# Replace this path with your conda environment's gdal_translate.exe location
-GDAL_TRANSLATE_EXE = r"C:\Users\User\miniconda3\envs\mars-mapper\Library\bin\gdal_translate.exe"
-
 # Enable GDAL exceptions
 gdal.UseExceptions()
 
@@ -26,97 +31,293 @@ PROCESSED_DIR = BASE_DIR / "processed_data"
 TILES_DIR = BASE_DIR / "map_tiles"
 MERGED_TIF = PROCESSED_DIR / "mosaic.tif"
 ZOOM_LEVELS = "10-18"
+# False: gdal2tiles reads the VRT directly (no full-resolution intermediate mosaic).
+# True:  the VRT is first materialized into MERGED_TIF and tiles are cut from that.
+MATERIALIZE_MOSAIC = False
+NUM_WORKERS = max(1, multiprocessing.cpu_count() - 2)
+# GDAL threads per Step 1 worker; keeps workers x threads within the core count.
+THREADS_PER_WORKER = max(1, multiprocessing.cpu_count() // NUM_WORKERS)
+# Step 3 gdal2tiles processes, each getting an equal share of the cores for tile decompression.
+TILING_PROCESSES = 4
+TILING_THREADS = max(1, multiprocessing.cpu_count() // TILING_PROCESSES)
+# GDAL block cache in MB; split evenly across the worker processes of Steps 1 and 3.
+GDAL_CACHEMAX_MB = 2048
+# Step 1 converter, run under this same Python interpreter (so it sees the same GDAL install)
+BATCH_WORKER_SCRIPT = BASE_DIR / "jp2_batch_worker.py"
+INTERMEDIATE_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'BIGTIFF=YES',
+                                 'COMPRESS=LERC_ZSTD', 'MAX_Z_ERROR=0', 'ZSTD_LEVEL=1',
+                                 f'NUM_THREADS={THREADS_PER_WORKER}']
+
+# Inherited by the gdal2tiles processes in Step 3 (Step 1 workers get their own values)
+os.environ['GDAL_NUM_THREADS'] = str(TILING_THREADS)
+os.environ['GDAL_CACHEMAX'] = str(max(1, GDAL_CACHEMAX_MB // TILING_PROCESSES))
+
+# ----------------- Worker Logging -----------------
+# Workers hand their messages to a shared queue; a single thread in the parent prints them.
+_log_queue = None
+
+def _log(msg: str):
+    if _log_queue is None:
+        print(msg)
+    else:
+        _log_queue.put(msg)
+
+def _drain_log_queue(log_q):
+    while True:
+        msg = log_q.get()
+        if msg is None:
+            break
+        print(msg)
+
+# ----------------- JP2 Conversion Worker (persistent GDAL subprocess) -----------------
+# Each pool worker owns one jp2_batch_worker.py process for its whole lifetime, so GDAL
+# is initialized once per worker rather than once per JP2. The batch worker keeps GDAL
+# errors out of Python exceptions and falls back to gdal_translate for any JP2 whose
+# metadata still trips the bindings' UTF-8 decoding.
+_converter = None
+
+def _init_worker(log_q):
+    global _log_queue
+    _log_queue = log_q
+    _start_converter()
+    # Pool workers leave via os._exit, which skips atexit; multiprocessing finalizers still run.
+    multiprocessing.util.Finalize(None, _stop_converter, exitpriority=10)
+
+def _start_converter():
+    global _converter
+    env = dict(os.environ,
+               GDAL_NUM_THREADS=str(THREADS_PER_WORKER),
+               GDAL_CACHEMAX=str(max(1, GDAL_CACHEMAX_MB // NUM_WORKERS)))
+    _converter = subprocess.Popen(
+        [sys.executable, str(BATCH_WORKER_SCRIPT), *INTERMEDIATE_CREATION_OPTIONS],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        bufsize=1,
+        env=env
+    )
+
+def _stop_converter():
+    # EOF on stdin ends the batch worker's read loop; wait so it isn't left orphaned.
+    if _converter is not None:
+        try:
+            _converter.stdin.close()
+        except OSError:  # Already dead with unflushed input
+            pass
+        _converter.wait()
+
+# ----------------- Intermediate Manifests -----------------
+# Each intermediate GeoTIFF has a <name>.tif.json next to it recording the exact JP2 and the
+# creation options it was written from. A GeoTIFF is reused only when that record matches the
+# current JP2 and options exactly, so replaced sources (even with an older mtime) and
+# outputs from earlier pipeline versions are converted again.
+def _output_tif(jp2_path: Path) -> Path:
+    return PROCESSED_DIR / jp2_path.name.replace(".JP2", ".tif")
+
+def _manifest_path(output_tif: Path) -> Path:
+    return output_tif.with_name(output_tif.name + ".json")
 
-# ----------------- JP2 Conversion Worker (CLI) -----------------
-def process_single_jp2_cli(jp2_path: Path):
+def _expected_manifest(jp2_path: Path) -> dict:
+    stat = jp2_path.stat()
+    return {
+        "source": jp2_path.name,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        # NUM_THREADS only depends on the machine, not on the file contents
+        "creation_options": [o for o in INTERMEDIATE_CREATION_OPTIONS if not o.startswith("NUM_THREADS=")],
+    }
+
+def _is_up_to_date(jp2_path: Path, output_tif: Path) -> bool:
+    if not output_tif.exists():
+        return False
+    try:
+        recorded = json.loads(_manifest_path(output_tif).read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return False
+    return recorded == _expected_manifest(jp2_path)
+
+def process_single_jp2(jp2_path: Path):
     """
-    Convert JP2 → GeoTIFF using the gdal_translate CLI.
-    Fully avoids Python UTF-8 decode errors.
+    Convert JP2 → lossless LERC_ZSTD tiled GeoTIFF using this worker's batch converter.
+    Returns (output path, skipped) on success, None on failure.
     """
+    output_tif = _output_tif(jp2_path)
+    if _is_up_to_date(jp2_path, output_tif):
+        _log(f"  == Skipping {jp2_path.name}, GeoTIFF is up to date")
+        return str(output_tif), True
+    _log(f"  -> Converting {jp2_path.name} to GeoTIFF...")
+
+    if _converter.poll() is not None:
+        _log(f"  !! Batch worker exited (code {_converter.returncode}), restarting it")
+        _start_converter()
     try:
-        output_tif = PROCESSED_DIR / jp2_path.name.replace(".JP2", ".tif")
-        print(f"  -> Converting {jp2_path.name} to GeoTIFF using gdal_translate...")
-
-        cmd = [
-            GDAL_TRANSLATE_EXE,
-            "-of", "GTiff",
-            "-co", "TILED=YES",
-            "-co", "COMPRESS=LZW",
-            "-co", "BIGTIFF=YES",
-            str(jp2_path),
-            str(output_tif)
-        ]
-
-        subprocess.run(cmd, check=True)
-        print(f"  <- Finished {jp2_path.name}")
-        return str(output_tif)
-
-    except subprocess.CalledProcessError as e:
-        print(f"!!!!!! ERROR converting {jp2_path.name}: {e}")
+        _converter.stdin.write(f"{jp2_path}\t{output_tif}\n")
+        _converter.stdin.flush()
+        reply = _converter.stdout.readline()
+    except OSError:  # The batch worker died and closed its pipes
+        reply = ""
+    status, _, detail = reply.rstrip('\n').partition('\t')
+
+    # Each reply must answer this request; anything else means the worker died or the
+    # stream is out of step, and no later reply from it could be trusted.
+    if status not in ("OK", "ERR") or (status == "OK" and detail != str(output_tif)):
+        _converter.kill()
+        _converter.wait()
+        _start_converter()
+        detail = f"unexpected reply from batch worker: {reply!r}" if reply else "batch worker exited unexpectedly"
+        status = "ERR"
+
+    if status != "OK":
+        _log(f"!!!!!! ERROR converting {jp2_path.name}: {detail}")
         return None
+    _manifest_path(output_tif).write_text(json.dumps(_expected_manifest(jp2_path)), encoding='utf-8')
+    _log(f"  <- Finished {jp2_path.name}")
+    return str(output_tif), False
 
 # ----------------- Main Pipeline -----------------
-def main():
+def main(clean: bool = False):
     script_start_time = time.time()
-    print("========== Mars Data Processing Pipeline (gdal_translate CLI) ==========\n")
+    gdal.SetCacheMax(GDAL_CACHEMAX_MB << 20)
+    print("========== Mars Data Processing Pipeline (batch GDAL workers) ==========\n")
 
-    # Step 0: Clean previous runs
-    print("\n--- Step 0: Cleaning up previous run... ---")
+    # Step 0: Clean previous runs (only with --clean; otherwise reuse up-to-date outputs)
+    if clean:
+        print("\n--- Step 0: Cleaning up previous run... ---")
+        for directory in [PROCESSED_DIR, TILES_DIR]:
+            if directory.exists():
+                shutil.rmtree(directory)
+        print("--- Cleanup complete ---")
+    else:
+        print("\n--- Step 0: Resuming previous run (pass --clean to start over) ---")
     for directory in [PROCESSED_DIR, TILES_DIR]:
-        if directory.exists():
-            shutil.rmtree(directory)
         directory.mkdir(parents=True, exist_ok=True)
-    print("--- Cleanup complete ---")
 
-    # Step 1: Convert JP2 to GeoTIFF (CLI, Serial)
-    print("\n========== Step 1: Converting JP2 files to GeoTIFF (Serial via CLI) ==========")
+    # Step 1: Convert JP2 to GeoTIFF (batch workers, Parallel)
+    print(f"\n========== Step 1: Converting JP2 files to GeoTIFF (Parallel, {NUM_WORKERS} batch workers) ==========")
     step1_start_time = time.time()
     jp2_files = list(RAW_DATA_DIR.glob("*.JP2"))
     if not jp2_files:
         print(f"!!!!!! ERROR: No .JP2 files found in '{RAW_DATA_DIR}'. Aborting.")
         return
 
-    tif_files = []
+    # Drop everything that isn't a current JP2's GeoTIFF or manifest: intermediates of removed
+    # JP2s, .part files from interrupted conversions, and a mosaic.tif from earlier runs.
+    # mosaic.vrt is kept only because Step 2 overwrites it anyway.
+    keep = {"mosaic.vrt"}
     for jp2_path in jp2_files:
-        result = process_single_jp2_cli(jp2_path)
-        if result:
-            tif_files.append(result)
+        output_tif = _output_tif(jp2_path)
+        keep.update({output_tif.name, _manifest_path(output_tif).name})
+    stale_files = [f for f in PROCESSED_DIR.iterdir() if f.is_file() and f.name not in keep]
+    for stale_file in stale_files:
+        stale_file.unlink()
+    if stale_files:
+        print(f"  -> Removed {len(stale_files)} stale file(s) from '{PROCESSED_DIR.name}'.")
+
+    tif_files = []
+    skipped_count = 0
+    with multiprocessing.Manager() as manager:
+        log_q = manager.Queue()
+        log_thread = threading.Thread(target=_drain_log_queue, args=(log_q,), daemon=True)
+        log_thread.start()
+        with ProcessPoolExecutor(max_workers=NUM_WORKERS, initializer=_init_worker, initargs=(log_q,)) as executor:
+            # Keep at most 2 x NUM_WORKERS futures alive; refill as each one completes.
+            jp2_iter = iter(jp2_files)
+            pending = {executor.submit(process_single_jp2, jp2_path)
+                       for jp2_path in islice(jp2_iter, 2 * NUM_WORKERS)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if result:
+                        tif_file, skipped = result
+                        tif_files.append(tif_file)
+                        skipped_count += skipped
+                    next_jp2 = next(jp2_iter, None)
+                    if next_jp2 is not None:
+                        pending.add(executor.submit(process_single_jp2, next_jp2))
+        log_q.put(None)
+        log_thread.join()
 
     if not tif_files or len(tif_files) != len(jp2_files):
         print("!!!!!! ERROR: Some files failed to convert. Aborting pipeline.")
         return
 
-    print(f"--- Step 1 finished. Converted {len(tif_files)} files. Took {time.time() - step1_start_time:.2f}s ---")
+    print(f"--- Step 1 finished. Converted {len(tif_files) - skipped_count} files, "
+          f"skipped {skipped_count} up-to-date files. Took {time.time() - step1_start_time:.2f}s ---")
+
+    # gdal2tiles --resume never redraws an existing tile, so it is only safe when the tiles
+    # on disk were cut from exactly these GeoTIFFs (i.e. we are finishing an interrupted
+    # tiling). The stamp records which inputs the current tiles came from and when tiling started.
+    tiles_stamp = TILES_DIR / ".tiled_inputs"
+    tiled_inputs = "\n".join(sorted(tif_files))
+    resume_tiles = (tiles_stamp.exists()
+                    and tiles_stamp.read_text(encoding='utf-8') == tiled_inputs
+                    and all(Path(t).stat().st_mtime < tiles_stamp.stat().st_mtime for t in tif_files))
 
     # Step 2: Merge GeoTIFFs into a mosaic
     print("\n========== Step 2: Merging all GeoTIFFs into a single mosaic ==========")
     step2_start_time = time.time()
     vrt_file = PROCESSED_DIR / "mosaic.vrt"
     print("  -> Building VRT...")
-    gdal.BuildVRT(str(vrt_file), tif_files)
+    vrt_options = gdal.BuildVRTOptions(resolution='highest', separate=False, addAlpha=False,
+                                       hideNodata=False, resampleAlg='nearest')
+    vrt_ds = gdal.BuildVRT(str(vrt_file), tif_files, options=vrt_options)
+    vrt_ds = None
     print("  <- VRT built successfully.")
 
-    print("  -> Materializing VRT to final TIFF...")
-    merge_options = gdal.TranslateOptions(
-        format='GTiff',
-        creationOptions=['TILED=YES','COMPRESS=LZW','NUM_THREADS=ALL_CPUS','BIGTIFF=YES']
-    )
-    gdal.Translate(str(MERGED_TIF), str(vrt_file), options=merge_options)
-    print(f"--- Step 2 finished. Merged into {MERGED_TIF.name}. Took {time.time() - step2_start_time:.2f}s ---")
+    if MATERIALIZE_MOSAIC:
+        print("  -> Materializing VRT to final Cloud-Optimized GeoTIFF...")
+        # gdalwarp -multi -wm 2048 -wo NUM_THREADS=ALL_CPUS: parallel block copy, unlike Translate.
+        merge_options = gdal.WarpOptions(
+            format='COG',
+            multithread=True,
+            warpOptions=['NUM_THREADS=ALL_CPUS'],
+            warpMemoryLimit=2048,
+            creationOptions=['COMPRESS=ZSTD','LEVEL=1','PREDICTOR=YES','BLOCKSIZE=512','NUM_THREADS=ALL_CPUS','BIGTIFF=YES',
+                             'OVERVIEWS=NONE']
+        )
+        MERGED_TIF.unlink(missing_ok=True)  # gdal.Warp would otherwise warp into the old mosaic
+        gdal.Warp(str(MERGED_TIF), str(vrt_file), options=merge_options)
+        tiles_source = MERGED_TIF
+
+        # Intermediates are what lets the next run skip unchanged JP2s, so keep them unless
+        # this is a from-scratch run.
+        if clean:
+            print("  -> Removing intermediate GeoTIFFs...")
+            for tif_file in tif_files:
+                Path(tif_file).unlink()
+                _manifest_path(Path(tif_file)).unlink(missing_ok=True)
+    else:
+        # The JP2 tiles do not overlap, so gdal2tiles can read straight through the VRT.
+        tiles_source = vrt_file
+    print(f"--- Step 2 finished. Merged into {tiles_source.name}. Took {time.time() - step2_start_time:.2f}s ---")
 
     # Step 3: Generate map tiles (Parallel via gdal2tiles)
     print("\n========== Step 3: Generating map tiles from the mosaic ==========")
     step3_start_time = time.time()
+    if resume_tiles:
+        print("  -> Inputs unchanged since the last tiling run; resuming it.")
+    else:
+        print("  -> Inputs changed (or no previous tiles); clearing old tiles...")
+        shutil.rmtree(TILES_DIR)
+        TILES_DIR.mkdir(parents=True, exist_ok=True)
+        tiles_stamp.write_text(tiled_inputs, encoding='utf-8')
     argv = [
         "gdal2tiles.py",
-        "--processes=4",
+        f"--processes={TILING_PROCESSES}",
         "--zoom=" + ZOOM_LEVELS,
         "--profile=geodetic",
-        "-w", "leaflet",
+        "-w", "none",    # app/index.html is the viewer; skip gdal2tiles' HTML/XML output
+        "--exclude",     # Don't write fully transparent tiles
         "-v",
-        str(MERGED_TIF),
+        str(tiles_source),
         str(TILES_DIR)
     ]
+    if resume_tiles:
+        argv.insert(1, "--resume")
     print(f"  -> Arguments for gdal2tiles: {' '.join(argv[1:])}")
     gdal2tiles.main(argv)
     print(f"--- Step 3 finished. Tiles generated. Took {time.time() - step3_start_time:.2f}s ---")
@@ -128,4 +329,9 @@ def main():
 
 # ----------------- Entry Point -----------------
 if __name__ == '__main__':
-    main()
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Mars Mapper data processing pipeline")
+    parser.add_argument("--clean", action="store_true",
+                        help="delete previous outputs and rebuild everything from scratch")
+    args = parser.parse_args()
+    main(clean=args.clean)
@@ -1,16 +1,21 @@
 # tile_calculator.py
-import math
+import numpy as np
 
-def tile_to_lat_lon(z, x, y):
-    """將 TMS 瓦片坐標轉換為緯度和經度。"""
+def tiles_to_lat_lon(z, x, y):
+    """將一批 TMS 瓦片坐標 (陣列) 一次轉換為緯度和經度陣列。"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
     n = 2.0 ** z
     # 經度計算
     lon_deg = x / n * 360.0 - 180.0
-    # 緯度計算 (使用 TMS 的 Y 坐標)
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y / n)))
-    lat_deg = math.degrees(lat_rad)
+    # 緯度計算 (使用 TMS 的 Y 坐標；反 Gudermannian 函數，以 exp + atan 取代 sinh + atan)
+    lat_deg = np.degrees(2 * np.arctan(np.exp(np.pi * (1 - 2 * y / n))) - np.pi / 2)
     return (lat_deg, lon_deg)
 
+def tile_to_lat_lon(z, x, y):
+    """將 TMS 瓦片坐標轉換為緯度和經度。"""
+    return tuple(float(v) for v in tiles_to_lat_lon(z, x, y))
+
 # --- 在這裡輸入您已知的、確實存在的瓦片坐標 ---
 # 根據您之前的觀察，我們使用：
 zoom = 11